@@ -1,11 +1,11 @@
 from math import pi
+from functools import lru_cache
 from collections import namedtuple
 
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
 
-from scipy.fftpack import next_fast_len
 from einops import rearrange, repeat
 from einops.layers.torch import Rearrange
 
@@ -18,6 +18,27 @@ Intermediates = namedtuple('Intermediates', ['growth_latents', 'seasonal_latents
 def exists(val):
     return val is not None
 
+def maybe_compile(fn):
+    if not hasattr(torch, 'compile'):
+        return fn
+
+    return torch.compile(fn, dynamic = False)
+
+arange_cache = dict()
+
+def cached_arange(n, device):
+    # the arange over the sequence only depends on (n, device), which stay fixed over a training run
+
+    cache_key = (n, str(device))
+
+    if cache_key in arange_cache:
+        return arange_cache[cache_key]
+
+    arange = torch.arange(n, device = device)
+
+    arange_cache[cache_key] = arange
+    return arange
+
 # fourier helpers
 
 def fourier_extrapolate(signal, start, end):
@@ -31,60 +52,173 @@ def fourier_extrapolate(signal, start, end):
 
 # classes
 
+class Transpose(nn.Module):
+    def __init__(self, dim1, dim2):
+        super().__init__()
+        self.dim1 = dim1
+        self.dim2 = dim2
+
+    def forward(self, x):
+        return x.transpose(self.dim1, self.dim2)
+
 def InputEmbedding(time_features, model_dim, kernel_size = 3, dropout = 0.):
+    if kernel_size == 1:
+        # a pointwise conv is just a linear over the feature dim, no layout shuffling needed
+
+        return nn.Sequential(
+            nn.Linear(time_features, model_dim),
+            nn.Dropout(dropout)
+        )
+
     return nn.Sequential(
-        Rearrange('b n d -> b d n'),
+        Transpose(-1, -2),
         nn.Conv1d(time_features, model_dim, kernel_size = kernel_size, padding = kernel_size // 2),
         nn.Dropout(dropout),
-        Rearrange('b d n -> b n d'),
+        Transpose(-1, -2),
     )
 
 def FeedForward(dim, mult = 4, dropout = 0.):
     return nn.Sequential(
         nn.Linear(dim, dim * mult),
-        nn.Sigmoid(),
+        nn.SiLU(),
         nn.Dropout(dropout),
         nn.Linear(dim * mult, dim),
         nn.Dropout(dropout)
     )
 
+def subtract_and_norm(x, subtrahend, weight, bias, eps: float):
+    # residual subtraction and the following layernorm are both pointwise-ish and
+    # memory bound - compiling them together fuses the chain into a single pass
+
+    return F.layer_norm(x - subtrahend, x.shape[-1:], weight, bias, eps)
+
+@lru_cache(maxsize = None)
+def compiled_subtract_and_norm():
+    return maybe_compile(subtract_and_norm)
+
 class FeedForwardBlock(nn.Module):
     def __init__(
         self,
         *,
         dim,
+        torch_compile = False,
         **kwargs
     ):
         super().__init__()
+        self.torch_compile = torch_compile
         self.norm = nn.LayerNorm(dim)
         self.ff = FeedForward(dim, **kwargs)
         self.post_norm = nn.LayerNorm(dim)
 
-    def forward(self, x):
-        x = self.norm(x)
+    def forward(self, x, subtract = None):
+        if exists(subtract):
+            fn = compiled_subtract_and_norm() if self.torch_compile else subtract_and_norm
+            x = fn(x, subtract, self.norm.weight, self.norm.bias, self.norm.eps)
+        else:
+            x = self.norm(x)
+
         return self.post_norm(x + self.ff(x))
 
 # encoder related classes
 
 ## multi-head exponential smoothing attention
 
-def conv1d_fft(x, weights, dim = -2, weight_dim = -1):
+@lru_cache(maxsize = None)
+def next_fast_len(size):
+    # smallest 11-smooth number >= size
+    # pocketfft, which backs torch.fft, has fast radices for 2, 3, 5, 7, 11
+
+    next_size = size
+    while True:
+        remaining = next_size
+        for factor in (2, 3, 5, 7, 11):
+            while remaining % factor == 0:
+                remaining //= factor
+
+        if remaining == 1:
+            return next_size
+
+        next_size += 1
+
+conv_indices_cache = dict()
+
+def cached_conv_indices(N, M, device, pow2 = False):
+    # the sequence length is constant over a training run, so the fast
+    # length and gather indices can be computed once per (N, M, device)
+
+    cache_key = (N, M, str(device), pow2)
+
+    if cache_key in conv_indices_cache:
+        return conv_indices_cache[cache_key]
+
+    if pow2:
+        # cuFFT only handles half precision for power-of-2 sizes
+        fast_len = 1 << (N + M - 2).bit_length()
+    else:
+        fast_len = next_fast_len(N + M - 1)
+
+    # the +1 mod fast_len folds the circular roll(-1) of the irfft output
+    # into the gather, so it costs nothing at runtime
+
+    indices = torch.arange(start = fast_len - N, end = fast_len, dtype = torch.long, device = device)
+    indices = (indices + 1) % fast_len
+
+    conv_indices_cache[cache_key] = (fast_len, indices)
+    return fast_len, indices
+
+def conv1d_fft(x, weights, dim = -2, weight_dim = -1, bias = None, half_precision = False, weight_cache = None, weight_cache_key = None):
     # Algorithm 3 in paper
 
     N = x.shape[dim]
     M = weights.shape[weight_dim]
 
-    fast_len = next_fast_len(N + M - 1)
+    # optionally run the transforms in half precision for inference
+    # cuda only, and gradients would suffer, so fall back to full precision when training
+
+    use_half = half_precision and x.is_cuda and not torch.is_grad_enabled()
+
+    fast_len, indices = cached_conv_indices(N, M, x.device, pow2 = use_half)
+
+    if use_half:
+        orig_dtype = x.dtype
+        x, weights = x.half(), weights.half()
 
     f_x = torch.fft.rfft(x, n = fast_len, dim = dim)
-    f_weight = torch.fft.rfft(weights, n = fast_len, dim = weight_dim)
 
-    f_v_weight = f_x * rearrange(f_weight.conj(), '... -> ... 1')
-    out = torch.fft.irfft(f_v_weight, fast_len, dim = dim)
-    out = out.roll(-1, dims = (dim,))
+    # the smoothing weights only change when alpha does, so with gradients
+    # disabled their rfft can be reused across forwards from a caller-owned cache
+
+    use_cache = exists(weight_cache) and not weights.requires_grad
+    cache_key = (weight_cache_key, fast_len, use_half)
+
+    if use_cache and weight_cache.get('key') == cache_key:
+        f_weight = weight_cache['f_weight']
+    else:
+        f_weight = torch.fft.rfft(weights, n = fast_len, dim = weight_dim)
+
+        if use_cache:
+            weight_cache['key'] = cache_key
+            weight_cache['f_weight'] = f_weight
+
+    # the frequency-domain multiply can reuse f_x's storage when autograd is not
+    # recording, sparing a second fast_len-sized complex tensor between the transforms
+
+    if torch.is_grad_enabled():
+        f_v_weight = f_x * f_weight.conj().unsqueeze(-1)
+    else:
+        f_v_weight = f_x.mul_(f_weight.conj().unsqueeze(-1))
 
-    indices = torch.arange(start = fast_len - N, end = fast_len, dtype = torch.long, device = x.device)
+    out = torch.fft.irfft(f_v_weight, fast_len, dim = dim)
     out = out.index_select(dim, indices)
+
+    if use_half:
+        out = out.to(orig_dtype)
+
+    # fold any additive bias into the convolution output in-place, saving a full-size temporary
+
+    if exists(bias):
+        out = out.add_(bias)
+
     return out
 
 class MHESA(nn.Module):
@@ -93,43 +227,27 @@ class MHESA(nn.Module):
         *,
         dim,
         heads = 8,
-        dropout = 0.
+        half_precision_fft = False
     ):
         super().__init__()
         self.heads = heads
+        self.half_precision_fft = half_precision_fft
+        self.weight_fft_cache = dict()
         self.initial_state = nn.Parameter(torch.randn(heads, dim // heads))
 
-        self.dropout = nn.Dropout(dropout)
         self.alpha = nn.Parameter(torch.randn(heads))
 
         self.project_in = nn.Linear(dim, dim)
         self.project_out = nn.Linear(dim, dim)
 
-    def naive_Aes(self, x, weights):
-        n, h = x.shape[-2], self.heads
-
-        # in appendix A.1 - Algorithm 2
-
-        arange = torch.arange(n, device = x.device)
-
-        weights = repeat(weights, '... l -> ... t l', t = n)
-        indices = repeat(arange, 'l -> h t l', h = h, t = n)
-
-        indices = (indices - rearrange(arange + 1, 't -> 1 t 1')) % n
+        # lazily built on first forward, then reused - non-persistent so they
+        # stay out of the state dict but still follow the module across devices
 
-        weights = weights.gather(-1, indices)
-        weights = self.dropout(weights)
+        self.register_buffer('arange', None, persistent = False)
+        self.register_buffer('powers', None, persistent = False)
+        self.register_buffer('shifted_arange', None, persistent = False)
 
-        # causal
-
-        weights = weights.tril()
-
-        # multiply
-
-        output = einsum('b h n d, h m n -> b h m d', x, weights)
-        return output
-
-    def forward(self, x, naive = False):
+    def forward(self, x):
         b, n, d, h, device = *x.shape, self.heads, x.device
 
         # linear project in
@@ -138,42 +256,53 @@ class MHESA(nn.Module):
 
         # split out heads
 
-        x = rearrange(x, 'b n (h d) -> b h n d', h = h)
+        x = x.reshape(b, n, h, -1).permute(0, 2, 1, 3)
 
-        # temporal difference
+        # temporal difference, with the initial state prepended in the same op
 
-        x = torch.cat((
-            repeat(self.initial_state, 'h d -> b h 1 d', b = b),
-            x
-        ), dim = -2)
-
-        x = x[:, :, 1:] - x[:, :, :-1]
+        x = torch.diff(x, dim = -2, prepend = self.initial_state.unsqueeze(0).unsqueeze(2).expand(b, -1, 1, -1))
 
         # prepare exponential alpha
 
         alpha = self.alpha.sigmoid()
-        alpha = rearrange(alpha, 'h -> h 1')
+        alpha = alpha.unsqueeze(-1)
 
         # arange == powers
 
-        arange = torch.arange(n, device = device)
-        weights = alpha * (1 - alpha) ** torch.flip(arange, dims = (0,))
+        if not exists(self.arange) or self.arange.numel() != n or self.arange.device != device:
+            self.arange = torch.arange(n, device = device)
+            self.powers = torch.flip(self.arange, dims = (0,))
+            self.shifted_arange = self.arange + 1
 
-        if naive:
-            output = self.naive_Aes(x, weights)
-        else:
-            output = conv1d_fft(x, weights)
+        # compute the exponential decays in log domain - a fused mul + exp
+        # rather than a generic pow kernel, and shared across both weight sets
+        # logsigmoid(-alpha) == log(1 - sigmoid(alpha)) but stays finite even
+        # when the sigmoid saturates to exactly 1
+
+        log1m_alpha = F.logsigmoid(-self.alpha).unsqueeze(-1)
+
+        weights = alpha * torch.exp(log1m_alpha * self.powers)
 
         # get initial state contribution
 
-        init_weight = (1 - alpha) ** (arange + 1)
-        init_output = rearrange(init_weight, 'h n -> h n 1') * rearrange(self.initial_state, 'h d -> h 1 d')
+        init_weight = torch.exp(log1m_alpha * self.shifted_arange)
+        init_output = init_weight.unsqueeze(-1) * self.initial_state.unsqueeze(1)
 
-        output = output + init_output
+        # exponential smoothing as an fft convolution - Algorithm 3 in the paper
+        # O(n log n), versus O(n^2) time and memory for the naive attention matrix
+
+        output = conv1d_fft(
+            x,
+            weights,
+            bias = init_output,
+            half_precision = self.half_precision_fft,
+            weight_cache = self.weight_fft_cache,
+            weight_cache_key = (n, str(device), self.alpha._version)
+        )
 
         # merge heads
 
-        output = rearrange(output, 'b h n d -> b n (h d)')
+        output = output.permute(0, 2, 1, 3).reshape(b, n, d)
         return self.project_out(output)
 
 ## frequency attention
@@ -190,55 +319,89 @@ class FrequencyAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x):
+        device = x.device
+
         freqs = torch.fft.rfft(x, dim = 1)
+        num_freqs = freqs.shape[1]
 
-        # get amplitudes
+        # squared amplitudes - topk is monotonic under squaring, so the
+        # per-bin sqrt inside abs() never needs to run
 
-        amp = freqs.abs()
+        amp = freqs.real.pow(2).add_(freqs.imag.pow(2))
         amp = self.dropout(amp)
 
         # topk amplitudes - for seasonality, branded as attention
 
-        topk_amp, _ = amp.topk(k = self.K, dim = 1, sorted = True)
+        _, topk_indices = amp.topk(k = self.K, dim = 1, sorted = True)
+
+        # gather just the topk bins and invert them directly as a sum of K
+        # sinusoids - O(n k) instead of scattering into a zeroed full spectrum
+        # and paying for an O(n log n) irfft
+
+        topk_freqs = freqs.gather(1, topk_indices)
+
+        out_len = 2 * (num_freqs - 1)  # matches the output length of irfft
+        times = cached_arange(out_len, device)
 
-        # mask out all freqs with lower amplitudes than the lowest value of the topk above
+        angles = (2 * pi / out_len) * topk_indices.unsqueeze(1) * times.view(1, -1, 1, 1)
 
-        topk_freqs = freqs.masked_fill(amp < topk_amp[:, -1:], 0.+0.j)
+        # dc and nyquist bins are not doubled in the one-sided inverse transform
 
-        # inverse fft
+        is_edge_bin = (topk_indices == 0) | (topk_indices == num_freqs - 1)
+        scale = torch.where(is_edge_bin, 1., 2.) / out_len
 
-        return torch.fft.irfft(topk_freqs, dim = 1)
+        real, imag = topk_freqs.real, topk_freqs.imag
+        out = scale.unsqueeze(1) * (real.unsqueeze(1) * torch.cos(angles) - imag.unsqueeze(1) * torch.sin(angles))
+
+        return out.sum(dim = 2)
 
 ## level module
 
 class Level(nn.Module):
-    def __init__(self, time_features, model_dim):
+    def __init__(self, time_features, model_dim, half_precision_fft = False):
         super().__init__()
+        self.half_precision_fft = half_precision_fft
+        self.weight_fft_cache = dict()
         self.alpha = nn.Parameter(torch.Tensor([0.]))
         self.to_growth = nn.Linear(model_dim, time_features)
         self.to_seasonal = nn.Linear(model_dim, time_features)
 
-    def forward(self, x, latent_growth, latent_seasonal):
+        self.register_buffer('powers', None, persistent = False)
+
+    def forward(self, x, growth, seasonal):
         # following equation in appendix A.2
+        # growth and seasonal arrive already projected to time-feature space
+        # (batched across layers in ETSFormer.forward)
 
         n, device = x.shape[1], x.device
 
         alpha = self.alpha.sigmoid()
 
-        arange = torch.arange(n, device = device)
-        powers = torch.flip(arange, dims = (0,))
+        if not exists(self.powers) or self.powers.numel() != n or self.powers.device != device:
+            self.powers = torch.flip(torch.arange(n, device = device), dims = (0,))
 
         # Aes for raw time series signal with seasonal terms (from frequency attention) subtracted out
+        # and the auxiliary growth term
+
+        # the Aes weights are just the growth smoothing weights scaled by alpha
+        # decay in log domain, trading the generic pow kernel for mul + exp
+        # logsigmoid(-alpha) stays finite even when the sigmoid saturates to 1
 
-        seasonal =self.to_seasonal(latent_seasonal)
-        Aes_weights = alpha * (1 - alpha) ** powers
-        seasonal_normalized_term = conv1d_fft(x - seasonal, Aes_weights)
+        growth_smoothing_weights = torch.exp(F.logsigmoid(-self.alpha) * self.powers)
+        Aes_weights = alpha * growth_smoothing_weights
 
-        # auxiliary term
+        # both smoothing convolutions have the same length, so stack them and issue one batched rfft / irfft
 
-        growth = self.to_growth(latent_growth)
-        growth_smoothing_weights = (1 - alpha) ** powers
-        growth_term = conv1d_fft(growth, growth_smoothing_weights)
+        stacked = torch.stack((x - seasonal, growth))
+        stacked_weights = torch.stack((Aes_weights, growth_smoothing_weights)).unsqueeze(1)
+
+        seasonal_normalized_term, growth_term = conv1d_fft(
+            stacked,
+            stacked_weights,
+            half_precision = self.half_precision_fft,
+            weight_cache = self.weight_fft_cache,
+            weight_cache_key = (n, str(device), self.alpha._version)
+        ).unbind(dim = 0)
 
         return seasonal_normalized_term + growth_term
 
@@ -291,7 +454,9 @@ class ETSFormer(nn.Module):
         layers = 2,
         heads = 8,
         K = 4,
-        dropout = 0.
+        dropout = 0.,
+        half_precision_fft = False,
+        torch_compile = False
     ):
         super().__init__()
         assert (model_dim % heads) == 0, 'model dimension must be divisible by number of heads'
@@ -307,9 +472,9 @@ class ETSFormer(nn.Module):
 
             self.encoder_layers.append(nn.ModuleList([
                 FrequencyAttention(K = K, dropout = dropout),
-                MHESA(dim = model_dim, heads = heads, dropout = dropout),
-                FeedForwardBlock(dim = model_dim) if not is_last_layer else None,
-                Level(time_features = time_features, model_dim = model_dim)
+                MHESA(dim = model_dim, heads = heads, half_precision_fft = half_precision_fft),
+                FeedForwardBlock(dim = model_dim, torch_compile = torch_compile) if not is_last_layer else None,
+                Level(time_features = time_features, model_dim = model_dim, half_precision_fft = half_precision_fft)
             ]))
 
         self.growth_dampening_module = GrowthDampening(dim = model_dim, heads = heads)
@@ -317,6 +482,13 @@ class ETSFormer(nn.Module):
         self.latents_to_time_features = nn.Linear(model_dim, time_features)
         self.level_stack = LevelStack()
 
+        # the model is a chain of many small kernels, so python dispatch overhead
+        # dominates on fast hardware - optionally compile the whole forward away
+
+        if torch_compile:
+            assert hasattr(torch, 'compile'), 'torch_compile requires pytorch 2.0 or greater'
+            self.forward = torch.compile(self.forward, dynamic = False, mode = 'reduce-overhead')
+
     def forward(
         self,
         x,
@@ -334,17 +506,16 @@ class ETSFormer(nn.Module):
         latent_growths = []
         latent_seasonals = []
 
-        for freq_attn, mhes_attn, ff_block, level in self.encoder_layers:
+        for freq_attn, mhes_attn, ff_block, _ in self.encoder_layers:
             latent_seasonal = freq_attn(z)
             z = z - latent_seasonal
 
             latent_growth = mhes_attn(z)
-            z = z - latent_growth
 
             if exists(ff_block):
-                z = ff_block(z)
-
-            x = level(x, latent_growth, latent_seasonal)
+                z = ff_block(z, subtract = latent_growth)
+            else:
+                z = z - latent_growth
 
             latent_growths.append(latent_growth)
             latent_seasonals.append(latent_seasonal)
@@ -352,6 +523,25 @@ class ETSFormer(nn.Module):
         latent_growths = torch.stack(latent_growths, dim = -2)
         latent_seasonals = torch.stack(latent_seasonals, dim = -2)
 
+        # project every layer's latents to time-feature space in one batched matmul,
+        # with the growth and seasonal branches stacked alongside the layer dim
+        # so all 2 * layers small gemms collapse into a single kernel
+
+        levels = [level for *_, level in self.encoder_layers]
+
+        stacked_latents = torch.stack((latent_growths, latent_seasonals))
+
+        level_weight = torch.stack([torch.stack((level.to_growth.weight, level.to_seasonal.weight)) for level in levels], dim = 1)
+        level_bias = torch.stack([torch.stack((level.to_growth.bias, level.to_seasonal.bias)) for level in levels], dim = 1)
+        level_bias = level_bias.unsqueeze(1).unsqueeze(1)
+
+        growths, seasonals = einsum('s b n l d, s l t d -> s b n l t', stacked_latents, level_weight) + level_bias
+
+        # the level recurrence itself is sequential across layers and stays a loop
+
+        for ind, level in enumerate(levels):
+            x = level(x, growths[:, :, ind], seasonals[:, :, ind])
+
         latents = Intermediates(latent_growths, latent_seasonals, x)
 
         if num_steps_forecast == 0:
@@ -18,8 +18,7 @@ setup(
   ],
   install_requires=[
     'einops>=0.4',
-    'scipy',
-    'torch>=1.6',
+    'torch>=1.13',
   ],
   classifiers=[
     'Development Status :: 4 - Beta',